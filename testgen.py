@@ -1,11 +1,17 @@
 #!/usr/bin/env python3.8
 
 import os
+import functools
+import json
 import textwrap
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 import sys
 import importlib
 import inspect
+from types import ModuleType
+from typing import NamedTuple
 import colorama
 
 colorama.init()
@@ -16,8 +22,32 @@ from colorama import Fore, Back, Style
 #   |                    UTILITIES                     |
 #   +--------------------------------------------------+
 
+# what kind of object something is, as returned by `get_kind`
+KIND_OTHER = 0
+KIND_FUNC = 1
+KIND_METHOD = 2
+KIND_CLASS = 3
 
-def _build_tree(root, get_children, make_key, ignore_if):
+
+def get_kind(obj):
+    """ Classifies obj once, so callers can branch on the result instead of re-checking
+
+    Args:
+        obj: object in question
+
+    Returns:
+        One of KIND_CLASS, KIND_FUNC, KIND_METHOD or KIND_OTHER
+    """
+    if inspect.isclass(obj):
+        return KIND_CLASS
+    if inspect.isfunction(obj):
+        return KIND_FUNC
+    if inspect.ismethod(obj):
+        return KIND_METHOD
+    return KIND_OTHER
+
+
+def _build_tree(root, get_children, make_key, ignore_if=None):
     """ Builds a tree given a root node, a way to get children, and a way to make keys
 
     Args:
@@ -27,19 +57,29 @@ def _build_tree(root, get_children, make_key, ignore_if):
         ignore_if: (optional) a filter function
 
     Returns:
-        A recursively generated tree of {make_key(root): get_children(root)}
+        A tree of {make_key(root): get_children(root)}
     """
-    result = {}
     children = get_children(root)
     # if there are no children, just return the root (leaf)
     if not children:
         return root
-    # otherwise, keep going down
-    for item in children:
-        if ignore_if(item):
+    # otherwise, keep going down, using a worklist of (parent dict, key, node) instead
+    # of recursing
+    if ignore_if is None:
+        ignore_if = lambda x: False
+    result = {}
+    worklist = deque(
+        (result, make_key(item), item) for item in children if not ignore_if(item)
+    )
+    while worklist:
+        parent, key, node = worklist.popleft()
+        children = get_children(node)
+        if not children:
+            parent[key] = node
             continue
-        result[make_key(item)] = _build_tree(
-            root=item, get_children=get_children, make_key=make_key, ignore_if=ignore_if
+        subtree = parent[key] = {}
+        worklist.extend(
+            (subtree, make_key(item), item) for item in children if not ignore_if(item)
         )
     return result
 
@@ -56,15 +96,92 @@ def is_submodule(child, parent):
     """
     if not hasattr(parent, "__path__"):
         return False
+    return _is_submodule(child, parent.__name__ + ".", _path_prefix(parent))
+
+
+def _is_submodule(child, name_prefix, path_prefix):
+    """ `is_submodule`, with the parent's dotted name and directory (both with trailing
+    separators) precomputed
+    """
+    if not isinstance(child, ModuleType):
+        return False
+    name = child.__name__
+    if name.startswith(name_prefix):
+        return True
+    # only a top-level module (e.g. imported through sys.path) can still be in parent's
+    # directory without sharing its dotted name
+    return "." not in name and _is_under_path(child, path_prefix)
+
+
+def _path_prefix(module):
+    """ Returns the directory of a package with a trailing separator
+    """
+    # the trailing separator keeps /a/foo from matching /a/foobar
+    return os.path.join(module.__path__[0], "")
+
+
+def _is_under_path(child, prefix):
+    """ Returns True if child (a module) lives under the directory prefix
+    """
     if hasattr(child, "__path__"):
-        parentpath = parent.__path__[0]
         childpath = child.__path__[0]
-        return childpath.startswith(parentpath)
-    elif hasattr(child, "__file__"):
-        parentpath = parent.__path__[0]
-        childpath = child.__file__
-        return childpath.startswith(parentpath)
-    return False
+    else:
+        childpath = getattr(child, "__file__", None)
+    return isinstance(childpath, str) and childpath.startswith(prefix)
+
+
+# id(obj) -> (obj, members); obj is kept in the entry so its id can't be reused
+_MEMBERS_CACHE = {}
+
+
+def _getmembers(obj):
+    """ Memoized, cheaper version of `inspect.getmembers(obj)`
+
+    Reads the members straight out of `vars(obj)` (merged along the MRO for classes)
+    instead of calling `getattr` for every name in `dir(obj)`. This means attributes
+    that only exist through a module/class level `__getattr__` are not picked up.
+
+    Args:
+        obj: object to get the members of
+
+    Returns:
+        List of (name, value) pairs sorted by name, like `inspect.getmembers`
+    """
+    entry = _MEMBERS_CACHE.get(id(obj))
+    if entry is None or entry[0] is not obj:
+        if inspect.isclass(obj):
+            members = {}
+            for cls in reversed(obj.__mro__):
+                members.update(vars(cls))
+            # getattr would have unwrapped these into the function/bound method
+            members = {
+                k: v.__func__ if isinstance(v, (staticmethod, classmethod)) else v
+                for k, v in members.items()
+            }
+            members = sorted(members.items(), key=lambda x: x[0])
+        else:
+            try:
+                members = sorted(vars(obj).items(), key=lambda x: x[0])
+            except TypeError:  # no __dict__
+                members = inspect.getmembers(obj)
+        entry = (obj, members)
+        _MEMBERS_CACHE[id(obj)] = entry
+    return entry[1]
+
+
+@functools.lru_cache(maxsize=None)
+def _get_testables(obj, ignore):
+    # same as is_subfunction(x, obj) or is_subclass(x, obj), but only looks at obj once
+    if inspect.isclass(obj):
+        modname = obj.__module__
+    elif inspect.ismodule(obj):
+        modname = obj.__name__
+    else:
+        return ()
+    is_testable = lambda x, _modname=modname: (
+        get_kind(x) != KIND_OTHER and x.__module__ == _modname
+    )
+    return tuple(v for k, v in _getmembers(obj) if k not in ignore and is_testable(v))
 
 
 def get_testables(obj, ignore=None):
@@ -77,10 +194,20 @@ def get_testables(obj, ignore=None):
     Returns:
         List of testables (functions, classes, or methods) belonging to obj
     """
-    ignore = set(ignore) if ignore else {}
-    is_testable = lambda x: (is_subfunction(x, obj) or is_subclass(x, obj))
-    testables = inspect.getmembers(obj, predicate=is_testable)
-    return [v for k, v in testables if k not in ignore]
+    ignore = frozenset(ignore) if ignore else frozenset()
+    return list(_get_testables(obj, ignore))
+
+
+@functools.lru_cache(maxsize=None)
+def _get_submodules(module, ignore):
+    if not hasattr(module, "__path__"):
+        return ()
+    # get all submodules, getting rid of anything that's in ignore
+    name_prefix, path_prefix = module.__name__ + ".", _path_prefix(module)
+    is_sub = lambda x, _n=name_prefix, _p=path_prefix: _is_submodule(x, _n, _p)
+    return tuple(
+        v for k, v in _getmembers(module) if is_sub(v) and v.__name__ not in ignore
+    )
 
 
 def get_submodules(module, ignore):
@@ -92,12 +219,8 @@ def get_submodules(module, ignore):
     Returns:
         List of submodules for module
     """
-    # get all submodules
-    members = inspect.getmembers(module)
-    members = inspect.getmembers(module, predicate=lambda x: is_submodule(x, module))
-    # get rid of anything that's in ignore and return
-    submodules = [v for k, v in filter(lambda x: x[1].__name__ not in ignore, members)]
-    return submodules
+    ignore = frozenset(ignore) if ignore else frozenset()
+    return list(_get_submodules(module, ignore))
 
 
 def get_submodule_tree(root, ignore=None):
@@ -111,13 +234,12 @@ def get_submodule_tree(root, ignore=None):
             module objects (at the leaf level)
 
     """
-    ignore = set(ignore) if ignore else {}
-    get_children = lambda x: get_submodules(x, ignore)
-    ignore_if = lambda x: x.__name__ in ignore
+    # frozen up front so get_submodules doesn't have to convert it for every node
+    ignore = frozenset(ignore) if ignore else frozenset()
+    # get_submodules already drops anything in ignore, so there's no need for ignore_if
+    get_children = lambda x, _ignore=ignore: get_submodules(x, _ignore)
     make_key = lambda x: x.__name__
-    return _build_tree(
-        root, get_children=get_children, make_key=make_key, ignore_if=ignore_if
-    )
+    return _build_tree(root, get_children=get_children, make_key=make_key)
 
 
 def is_subfunction(obj, parent):
@@ -131,12 +253,14 @@ def is_subfunction(obj, parent):
     """
     if inspect.isclass(parent):
         return (
-            inspect.isfunction(obj) or inspect.ismethod(obj)
-        ) and obj.__module__ == parent.__module__
+            get_kind(obj) in (KIND_FUNC, KIND_METHOD)
+            and obj.__module__ == parent.__module__
+        )
     if inspect.ismodule(parent):
         return (
-            inspect.isfunction(obj) or inspect.ismethod(obj)
-        ) and obj.__module__ == parent.__name__
+            get_kind(obj) in (KIND_FUNC, KIND_METHOD)
+            and obj.__module__ == parent.__name__
+        )
     return False
 
 
@@ -150,9 +274,9 @@ def is_subclass(obj, parent):
         True if obj is a class and a member of parent
     """
     if inspect.isclass(parent):
-        return inspect.isclass(obj) and obj.__module__ == parent.__module__
+        return get_kind(obj) == KIND_CLASS and obj.__module__ == parent.__module__
     if inspect.ismodule(parent):
-        return inspect.isclass(obj) and obj.__module__ == parent.__name__
+        return get_kind(obj) == KIND_CLASS and obj.__module__ == parent.__name__
     return False
 
 
@@ -168,29 +292,52 @@ def indent(text, n, spaces=4):
     return textwrap.indent(text, " " * n * spaces)
 
 
-def get_function_test_name(func):
-    name = func.__name__
-    return f"test_{name}"
+# prebuilt prefixes for `_indent`
+_PREFIXES = ["    " * i for i in range(8)]
 
 
-def get_class_test_name(cls):
-    name = cls.__name__
-    return f"Test{name}"
+def _indent(text, n):
+    """ `indent` specialized to 4 spaces, using str.replace instead of textwrap
+
+    Only meant for the formatters' output: unlike `indent`, whitespace-only lines in
+    the middle of text get indented too, but the formatters never produce any.
+    """
+    prefix = _PREFIXES[n] if n < len(_PREFIXES) else "    " * n
+    # rstrip drops the prefix added after a trailing newline
+    return (prefix + text.replace("\n", "\n" + prefix)).rstrip(" ")
 
 
-def exists_test(obj, context):
-    """ Given an object and a list of members (context), determine if the test for obj exists
+def _test_name(obj, kind=None):
+    """ Returns the test name for obj: `TestName` for classes, `test_name` otherwise
     """
-    if inspect.isclass(obj):
-        name = get_class_test_name(obj)
-    elif inspect.isfunction(obj):
-        name = get_function_test_name(obj)
-    elif inspect.ismethod(obj):
-        name = get_function_test_name(obj)
-    for item in context:
-        if item.__name__ == name:
-            return item
-    return False
+    if kind is None:
+        kind = get_kind(obj)
+    if kind == KIND_CLASS:
+        return f"Test{obj.__name__}"
+    return f"test_{obj.__name__}"
+
+
+def exists_test(obj, context, kind=None):
+    """ Given an object and a dict of {name: member} (context), determine if the test
+    for obj exists
+    """
+    return context.get(_test_name(obj, kind), False)
+
+
+def get_mtimes(path, module):
+    """ Gets the modification times of a test file and the module it tests
+
+    Args:
+        path: path to the test file
+        module: the module being tested
+
+    Returns:
+        [module mtime, test file mtime] in nanoseconds, or None if module has no source
+    """
+    src = getattr(module, "__file__", None)
+    if src is None:
+        return None
+    return [os.stat(src).st_mtime_ns, os.stat(path).st_mtime_ns]
 
 
 #   +--------------------------------------------------+
@@ -198,6 +345,16 @@ def exists_test(obj, context):
 #   +--------------------------------------------------+
 
 
+class LeafTask(NamedTuple):
+    """ A leaf (single file) module to write tests for, as returned by `setup_files`
+    """
+
+    path: Path  # the test file
+    module: ModuleType  # the module being tested
+    testmod: str  # dotted name of the test module
+    testables: list  # get_testables(module)
+
+
 def _help_setup_files(base, modules):
     """ Helper function for `setup_files`
     """
@@ -205,33 +362,31 @@ def _help_setup_files(base, modules):
     if not isinstance(modules, dict):
         modules = {modules.__name__: modules}
     for name, submod in modules.items():
+        parts = name.split(".")
         # if the module is a directory, make the test directory
         if isinstance(submod, dict):
             # e.g. preprocess.script
-            subpath = base / "/".join(name.split(".")[1:])
+            subpath = base / "/".join(parts[1:])
             subpath.mkdir(exist_ok=True, parents=True)
             # print(subpath)
             result.extend(_help_setup_files(base, submod))
         else:  # otherwise, create a file and append it to the list
-            filename = "test_" + name.split(".")[-1] + ".py"
-            fullpath = base / "/".join(name.split(".")[1:-1]) / filename
+            testname = "test_" + parts[-1]
+            fullpath = base / "/".join(parts[1:-1]) / f"{testname}.py"
             fullpath.parent.mkdir(exist_ok=True, parents=True)
 
-            os.chdir(base.parent)
-            testmod = (
-                f"{base.stem}." + ".".join(name.split(".")[1:-1]) + f".{filename[:-3]}"
-            )
+            testmod = ".".join([base.name, *parts[1:-1], testname])
 
+            testables = get_testables(submod)
             if not fullpath.exists():
                 with open(fullpath, "a") as f:
-                    items = ",".join([v.__name__ for v in get_testables(submod)])
-                    if items:
+                    if testables:
+                        items = ",".join(v.__name__ for v in testables)
                         import_name = f"from {name} import {items}\n"
                     else:
                         import_name = f"import {name}\n"
-                    import_pytest = "import pytest\n"
-                    f.writelines([import_name, import_pytest])
-            result.append((fullpath, submod, testmod))
+                    f.write(import_name + "import pytest\n")
+            result.append(LeafTask(fullpath, submod, testmod, testables))
     return result
 
 
@@ -243,10 +398,13 @@ def setup_files(path, modules):
         modules (dict): A tree (dictionary) of 'module_name: {submodule_1: {...}} to write tests for. The
             leaves (i.e., single files) should be {module_name: <module object>}
     Returns:
-        List of (module, test_file, testmodule) for each leaf module in modules
+        List of `LeafTask`s, one for each leaf module in modules
     """
-    base = Path(path)
+    base = Path(path).resolve()
     base.mkdir(exist_ok=True, parents=True)
+    # the test modules are imported by name later on, so make sure they can be found
+    if str(base.parent) not in sys.path:
+        sys.path.insert(0, str(base.parent))
     return _help_setup_files(base, modules)
 
 
@@ -260,89 +418,173 @@ def format_function(function, is_method=False):
     Returns:
         None
     """
-    name = get_function_test_name(function)
+    name = _test_name(function)
     self = "self" if is_method else ""
     body = f"@pytest.mark.skip\n" f"def {name}({self}):\n" f"    pass\n"
 
     return body
 
 
-def format_class(cls, n=1, exists=None):
-    name = get_class_test_name(cls)
-    # if there are any functions that exist, the class exists too so don't write again
-    exists = set(exists) if exists else {}
-    if exists:
+def format_class(cls, n=1, existing_test_class=None):
+    """ Formats the corresponding test class, and tests for its members, into a string
+
+    Args:
+        cls: Class object to create test for
+        n: how many times to indent the members
+        existing_test_class: (optional) the test class for cls if it already exists.
+            In that case only tests for the members it doesn't have yet are formatted,
+            without the class header
+
+    Returns:
+        Formatted test class
+    """
+    name = _test_name(cls, KIND_CLASS)
+    if existing_test_class:
+        # the class exists already so don't write it again, just its missing members
         body = ""
+        exists = {t.__name__: t for t in get_testables(existing_test_class)}
     else:
         body = f"@pytest.mark.skip\n" f"class {name}:\n" f"    '''\n" f"    '''\n"
+        exists = {}
+    # everything from get_testables is already a function/method/class from cls' module
     for member in get_testables(cls, ["__init__"]):
-        if is_subfunction(member, cls):
+        kind = get_kind(member)
+        if kind == KIND_FUNC or kind == KIND_METHOD:
             # ignore the ones that already exist
-            if exists_test(member, exists):
+            if exists_test(member, exists, kind):
                 continue
-            body += indent(format_function(member, is_method=True), n=n, spaces=4)
-        if is_subclass(member, cls):
-            exists_in_subcls = get_testables(member, ["__init__"])
-            if not exists_in_subcls:
-                exists_in_subcls = [member]  # just so it's not empty
-            body += indent(format_class(member, exists=exists_in_subcls), n=n, spaces=4)
+            body += _indent(format_function(member, is_method=True), n)
+        elif kind == KIND_CLASS:
+            existing = exists_test(member, exists, kind)
+            body += _indent(format_class(member, existing_test_class=existing), n)
     return body
 
 
-def format_member(obj, exists):
+def format_member(obj, exists, kind=None):
     """ Formats either function or class to file pointer fp
 
     Args:
         obj: object to write
         fp: file object to write to
+        kind: (optional) get_kind(obj), if already known
     Returns:
         Formatted member
     """
-    if inspect.isfunction(obj) and (get_function_test_name(obj.__name__) not in exists):
-        return format_function(obj, is_method=inspect.ismethod(obj))
-    if inspect.isclass(obj):
-        return format_class(obj, exists=exists)
+    if kind is None:
+        kind = get_kind(obj)
+    if kind == KIND_FUNC and f"test_{obj.__name__}" not in exists:
+        return format_function(obj)
+    if kind == KIND_CLASS:
+        return format_class(obj, existing_test_class=exists_test(obj, exists, kind))
     return ""
 
 
-def generate_tests(mods):
-    """ Given a list of (filepath, module), writes empty tests for each module
+def _generate_test_file(path, test_mod, members):
+    """ Appends empty tests to path for each of members that has no test in test_mod
 
     Args:
-        mods: a list of (filepath, module)
+        path: path to the test file
+        test_mod: the (imported) test module at path
+        members: the testables of the module being tested
 
     Returns:
         None
     """
-    for path, mod, testmod in mods:
-        # have to check if the function/class exists already
-        test_mod = importlib.import_module(testmod)
-        exists = get_testables(test_mod)
-        members = get_testables(mod)
+    # have to check if the function/class exists already
+    exists = {t.__name__: t for t in get_testables(test_mod)}
+    # collect everything for this file and write it out in one go
+    parts = []
+    for obj in members:
+        kind = get_kind(obj)
+        # only write the function if it doesn't exist already
+        if kind == KIND_FUNC:
+            if exists_test(obj, exists, kind):
+                continue
+            parts.append(format_function(obj))
+            parts.append("\n")
+        # if it's a class, we may want to write the methods, so we have to determine later
+        elif kind == KIND_CLASS:
+            test_obj = exists_test(obj, exists, kind)
+            body = format_class(obj, existing_test_class=test_obj)
+            # nothing to add if the test class already covers everything
+            if body:
+                parts.append(body)
+                parts.append("\n")
+    if parts:
         with open(path, "a") as f:
-            for obj in members:
-                # only write the function if it doesn't exist already
-                if inspect.isfunction(obj):
-                    if exists_test(obj, exists):
-                        continue
-                    body = format_function(obj, is_method=inspect.ismethod(obj))
-                    f.write(body + "\n")
-                # if it's a class, we may want to write the methods, so we have to determine later
-                elif inspect.isclass(obj):
-                    test_obj = exists_test(obj, exists)
-                    if test_obj:
-                        exists_in_cls = get_testables(test_obj)
-                        existing_items = [
-                            exists_test(i, exists_in_cls) for i in members
-                        ]
-                        existing_items = list(filter(None, existing_items))
-                        if not exists_in_cls:
-                            # the class exists, so just put an object here so it's not empty
-                            exists_in_cls = [obj]
-                        body = format_class(obj, exists=exists_in_cls)
-                    else:
-                        body = format_class(obj, exists=None)
-                    f.write(body + "\n")
+            f.write("".join(parts))
+
+
+def _init_worker(path):
+    """ Initializer for `generate_tests` workers, so they can import the test modules
+    """
+    sys.path[:] = path
+
+
+def _generate_test_file_by_name(path, modname, testmod):
+    """ `_generate_test_file` with modules given by name, so it can run in a worker
+    """
+    mod = sys.modules.get(modname) or importlib.import_module(modname)
+    test_mod = sys.modules.get(testmod) or importlib.import_module(testmod)
+    _generate_test_file(path, test_mod, get_testables(mod))
+
+
+def generate_tests(mods, cache=None):
+    """ Given a list of `LeafTask`s, writes empty tests for each module
+
+    Args:
+        mods: a list of `LeafTask`s, as returned by `setup_files`
+        cache: (optional) path to a JSON file of
+            {testmodule: [module mtime, test file mtime]} from the last run. Modules
+            whose source and test file are both unchanged since then are skipped
+            without importing or inspecting anything.
+
+    Returns:
+        None
+    """
+    mtimes = {}
+    if cache is not None and Path(cache).exists():
+        with open(cache) as f:
+            mtimes = json.load(f)
+    # anything we wrote last time that hasn't been touched since is already up to date
+    stale = [
+        task
+        for task in mods
+        if mtimes.get(task.testmod) is None
+        or mtimes[task.testmod] != get_mtimes(task.path, task.module)
+    ]
+    if len(stale) < 4:
+        # not worth starting up a process pool for, so just do it here
+        # import all the test modules in one pass, skipping the import machinery if
+        # they're already loaded
+        test_mods = {
+            task.testmod: sys.modules.get(task.testmod)
+            or importlib.import_module(task.testmod)
+            for task in stale
+        }
+        for task in stale:
+            _generate_test_file(task.path, test_mods[task.testmod], task.testables)
+    else:
+        # every file is independent, so spread them out over processes
+        with ProcessPoolExecutor(
+            max_workers=os.cpu_count(), initializer=_init_worker, initargs=(sys.path,)
+        ) as pool:
+            futures = [
+                pool.submit(
+                    _generate_test_file_by_name,
+                    task.path,
+                    task.module.__name__,
+                    task.testmod,
+                )
+                for task in stale
+            ]
+            for future in futures:
+                future.result()
+    for task in stale:
+        mtimes[task.testmod] = get_mtimes(task.path, task.module)
+    if cache is not None:
+        with open(cache, "w") as f:
+            json.dump(mtimes, f)
 
 
 if __name__ == "__main__":
@@ -366,4 +608,4 @@ if __name__ == "__main__":
         mod = importlib.import_module(mod)
         modules = get_submodule_tree(mod)
         mods = setup_files(sys.argv[-1], modules)
-        generate_tests(mods)
+        generate_tests(mods, cache=Path(sys.argv[-1]) / ".testgen_cache.json")